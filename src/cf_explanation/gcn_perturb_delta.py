@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.parameter import Parameter
-from utils.utils import get_degree_matrix, BernoulliMLSample, create_symm_matrix_tril
+from utils.utils import bernoulli_ml_sample, create_symm_matrix_tril, \
+    create_symm_matrix_from_trilvec
 
 
 class GCNSyntheticPerturbDelta(nn.Module):
@@ -32,7 +33,7 @@ class GCNSyntheticPerturbDelta(nn.Module):
         self.cem_mode = cem_mode
         self.device = device
 
-        self.BML = BernoulliMLSample.apply
+        self.BML = bernoulli_ml_sample
 
         self.edge_del = edge_del  # Can the explainer delete new edges to the graph
         self.edge_add = edge_add  # Can the explainer add new edges to the graph
@@ -40,24 +41,64 @@ class GCNSyntheticPerturbDelta(nn.Module):
         if not edge_del and not edge_add:
             raise RuntimeError("GCNSyntheticPerturbDelta: need to specify allowed add/del op")
 
+        # Resolve the forward/loss variant once: branching on bernoulli/cem_mode at
+        # every call adds interpreter overhead to the hot loop and blocks fullgraph
+        # tracing in the explainer
+        if self.bernoulli:
+            self.fwd_fn = self.__forward_bernoulli
+
+            if self.cem_mode is None or self.cem_mode == "PN":
+                self.loss_fn = self.__loss_bernoulli
+            elif self.cem_mode == "PP":
+                self.loss_fn = self.__loss_PP_bernoulli
+        else:
+            self.fwd_fn = self.__forward_std
+
+            if self.cem_mode is None or self.cem_mode == "PN":
+                self.loss_fn = self.__loss_std
+            elif self.cem_mode == "PP":
+                self.loss_fn = self.__loss_PP_std
+
         # Number of nodes in the adj, in case of graph-class includes padding
         self.num_nodes_adj = self.adj.shape[1]
+
+        # The identity added by the reparam trick in normalize_adj() never changes:
+        # build it once and pass it down, instead of allocating a fresh eye inside
+        # every forward. Only the node-class model normalizes the adj
+        if task == "node-class":
+            self.fwd_kwargs = {"norm_eye": torch.eye(self.num_nodes_adj,
+                                                     device=self.device)}
+        else:
+            self.fwd_kwargs = {}
         self.init_eps = 10**-6
 
         if 0 < self.rand_init < self.init_eps:
             raise RuntimeError("GCNSyntheticPerturbDelta: rand_init value too small")
 
         # The optimizer will affect only the elements below the diag of this matrix
-        # This is enforced through the function create_symm_matrix_tril(), which constructs the 
+        # This is enforced through the function create_symm_matrix_tril(), which constructs the
         # symmetric matrix to optimize using only the lower triangular elements of P_tril
         # Note: no diagonal, it is assumed to be always 0/no self-connections allowed
+        if self.edge_add:
+            # Additions can touch any non-edge, so P keeps the dense parameterization
+            self.symm_from_P = self.__symm_dense
+            P_shape = (self.num_nodes_actual, self.num_nodes_actual)
+            # The complement of the adj masks the candidate additions and never
+            # changes: compute it once instead of on every forward/loss call
+            self.adj_compl = 1 - self.adj
+        else:
+            # Deletions only act on existing edges: parameterize P as a 1-D vector
+            # over the tril support of the adj, so the parameter and its optimizer
+            # state scale with the number of edges instead of num_nodes^2
+            self.P_edge_idx = torch.tril(self.adj, -1).nonzero().t()
+            self.symm_from_P = self.__symm_edge_list
+            P_shape = (self.P_edge_idx.shape[1],)
+
         if self.bernoulli:
-            self.P_tril = Parameter(torch.zeros((self.num_nodes_actual, self.num_nodes_actual),
-                                                device=self.device))
+            self.P_tril = Parameter(torch.zeros(P_shape, device=self.device))
         else:
             # Need to guarantee that the initial permutation matrix is all 0s after applying sigm
-            self.P_tril = Parameter(torch.full((self.num_nodes_actual, self.num_nodes_actual),
-                                               -self.init_eps, device=self.device))
+            self.P_tril = Parameter(torch.full(P_shape, -self.init_eps, device=self.device))
 
         # The idea behind the init is simply to break any symmetries in the parameters, allowing
         # for more diverse explanations by avoiding the simultaneous addition/deletion of relevant
@@ -70,21 +111,20 @@ class GCNSyntheticPerturbDelta(nn.Module):
 
 
     def forward(self, x):
+        return self.fwd_fn(x)
 
-        diff_act, pred_act = None, None
 
-        if self.bernoulli:
-            diff_act, pred_act = self.__forward_bernoulli(x)
-        else:
-            diff_act, pred_act = self.__forward_std(x)
+    def __symm_dense(self, values):
+        return create_symm_matrix_tril(values, self.num_nodes_adj)
 
-        return diff_act, pred_act
+
+    def __symm_edge_list(self, values):
+        return create_symm_matrix_from_trilvec(values, self.P_edge_idx, self.num_nodes_adj)
 
 
     def __forward_std(self, x):
         # Use sigmoid to bound P_hat in [0,1]
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
         # Note: identity matrix is added in normalize_adj() inside model
@@ -92,8 +132,8 @@ class GCNSyntheticPerturbDelta(nn.Module):
         delta_pred = 0
 
         if self.edge_add:
-            delta_diff += (1 - self.adj) * P_hat_symm
-            delta_pred += (1 - self.adj) * P
+            delta_diff += self.adj_compl * P_hat_symm
+            delta_pred += self.adj_compl * P
 
         if self.edge_del:
             delta_diff -= P_hat_symm * self.adj
@@ -102,66 +142,51 @@ class GCNSyntheticPerturbDelta(nn.Module):
         A_tilde_diff = self.adj + delta_diff
         A_tilde_pred = self.adj + delta_pred
 
-        output_diff = self.model(x, A_tilde_diff.expand(1, -1, -1)).squeeze()
-        output_pred = self.model(x, A_tilde_pred.expand(1, -1, -1)).squeeze()
+        # Batch the relaxed and thresholded adjacencies into one forward pass: a
+        # single batched matmul chain keeps the device busy instead of two separate
+        # small ones
+        output_batch = self.model(x, torch.stack((A_tilde_diff, A_tilde_pred)), **self.fwd_kwargs)
 
-        return output_diff, output_pred
+        return output_batch[0], output_batch[1]
 
 
     def __forward_bernoulli(self, x):
 
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
         delta = 0
 
         # Note: identity matrix is added in normalize_adj() inside model
         if self.edge_add:
-            delta += (1 - self.adj) * P
+            delta += self.adj_compl * P
 
         if self.edge_del:
             delta -= P * self.adj
 
         A_tilde = self.adj + delta
 
-        output = self.model(x, A_tilde.expand(1, -1, -1)).squeeze()
+        output = self.model(x, A_tilde.expand(1, -1, -1), **self.fwd_kwargs).squeeze()
 
         return output, output
 
 
-    def loss(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-
-        if self.bernoulli:
-
-            if self.cem_mode is None or self.cem_mode == "PN":
-                res = self.__loss_bernoulli(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PP":
-                res = self.__loss_PP_bernoulli(output, y_pred_orig, y_pred_new_actual, prev_expls)
-
-        else:
-
-            if self.cem_mode is None or self.cem_mode == "PN":
-                res = self.__loss_std(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PP":
-                res = self.__loss_PP_std(output, y_pred_orig, y_pred_new_actual, prev_expls)
-
-        return res
+    def loss(self, output, y_pred_new_actual, prev_expls):
+        return self.loss_fn(output, y_pred_new_actual, prev_expls)
 
 
-    def __loss_std(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+    def __loss_std(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
-        pred_same = (y_pred_new_actual == y_pred_orig).float()
+        pred_same = (y_pred_new_actual == self.y_pred_orig_const).float()
 
         # Init to 0, since it will be broadcasted into the appropriate shape by torch
         delta_diff = 0
         delta_actual = 0
 
         if self.edge_add:
-            mat_constr = 1 - self.adj
-            delta_diff += mat_constr * P_hat_symm
-            delta_actual += mat_constr * P
+            delta_diff += self.adj_compl * P_hat_symm
+            delta_actual += self.adj_compl * P
 
         if self.edge_del:
             delta_diff -= P_hat_symm * self.adj
@@ -171,15 +196,20 @@ class GCNSyntheticPerturbDelta(nn.Module):
         cf_adj_actual = self.adj + delta_actual
 
         # Want negative in front to maximize loss instead of minimizing it to find CFs
-        loss_pred = - F.nll_loss(output, y_pred_orig)
+        loss_pred = - F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges changed (symmetrical), used for the metrics
         loss_graph_dist_actual = torch.sum(torch.abs(delta_actual)) / 2
         # Relaxation to continuous space of loss_graph_dist_actual, used for the loss
         loss_graph_dist_diff = torch.sum(torch.abs(delta_diff)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj_diff, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj_diff.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_same * loss_pred + self.beta * loss_graph_dist_diff \
@@ -188,16 +218,16 @@ class GCNSyntheticPerturbDelta(nn.Module):
         return loss_total, loss_graph_dist_actual, cf_adj_diff, cf_adj_actual
 
 
-    def __loss_bernoulli(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+    def __loss_bernoulli(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
 
-        pred_same = (y_pred_new_actual == y_pred_orig).float()
+        pred_same = (y_pred_new_actual == self.y_pred_orig_const).float()
         delta = 0
 
         # Note: the differentiable and actual formulations are identical
         if self.edge_add:
-            delta += (1 - self.adj) * P
+            delta += self.adj_compl * P
 
         if self.edge_del:
             delta -= P * self.adj
@@ -205,13 +235,18 @@ class GCNSyntheticPerturbDelta(nn.Module):
         cf_adj = self.adj + delta
 
         # Want negative in front to maximize loss instead of minimizing it to find CFs
-        loss_pred = - F.nll_loss(output, y_pred_orig)
+        loss_pred = - F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges changed (symmetrical)
         loss_graph_dist = torch.sum(torch.abs(delta)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_same * loss_pred + self.beta * loss_graph_dist \
@@ -220,13 +255,12 @@ class GCNSyntheticPerturbDelta(nn.Module):
         return loss_total, loss_graph_dist, cf_adj, cf_adj
 
 
-    def __loss_PP_std(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+    def __loss_PP_std(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
         # Note: flipped the boolean since we want the same prediction
-        pred_diff = (y_pred_new_actual != y_pred_orig).float()
+        pred_diff = (y_pred_new_actual != self.y_pred_orig_const).float()
 
         # Init to 0, since it will be broadcasted into the appropriate shape by torch
         delta_diff = 0
@@ -240,7 +274,7 @@ class GCNSyntheticPerturbDelta(nn.Module):
         cf_adj_actual = self.adj + delta_actual
 
         # Note: the negative sign is gone since we want to keep the same prediction
-        loss_pred = F.nll_loss(output, y_pred_orig)
+        loss_pred = F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges in neighbourhood (symmetrical)
         # Note: here we are interested in finding the most sparse cf_adj with the same pred
         loss_graph_dist = torch.sum(torch.abs(cf_adj_diff)) / 2
@@ -251,8 +285,13 @@ class GCNSyntheticPerturbDelta(nn.Module):
         loss_graph_dist_actual = torch.sum(torch.abs(self.adj - cf_adj_actual)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj_diff, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj_diff.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_diff * loss_pred + self.beta * loss_graph_dist \
@@ -261,12 +300,12 @@ class GCNSyntheticPerturbDelta(nn.Module):
         return loss_total, loss_graph_dist_actual, cf_adj_diff, cf_adj_actual
 
 
-    def __loss_PP_bernoulli(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+    def __loss_PP_bernoulli(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
 
         # Note: flipped the boolean since we want the same prediction
-        pred_diff = (y_pred_new_actual != y_pred_orig).float()
+        pred_diff = (y_pred_new_actual != self.y_pred_orig_const).float()
         delta = 0
 
         # edge_del equivalent
@@ -274,7 +313,7 @@ class GCNSyntheticPerturbDelta(nn.Module):
         cf_adj = self.adj + delta
 
         # Note: the negative sign is gone since we want to keep the same prediction
-        loss_pred = F.nll_loss(output, y_pred_orig)
+        loss_pred = F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges in neighbourhood (symmetrical)
         # Note: here we are interested in finding the most sparse cf_adj with the same pred
         loss_graph_dist = torch.sum(torch.abs(cf_adj)) / 2
@@ -285,8 +324,13 @@ class GCNSyntheticPerturbDelta(nn.Module):
         loss_graph_dist_actual = torch.sum(torch.abs(self.adj - cf_adj)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_diff * loss_pred + self.beta * loss_graph_dist \
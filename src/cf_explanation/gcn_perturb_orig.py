@@ -4,7 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.parameter import Parameter
-from utils.utils import get_degree_matrix, BernoulliMLSample, create_symm_matrix_tril
+from utils.utils import bernoulli_ml_sample, create_symm_matrix_tril, \
+    create_symm_matrix_from_trilvec
 
 
 class GCNSyntheticPerturbOrig(nn.Module):
@@ -32,7 +33,7 @@ class GCNSyntheticPerturbOrig(nn.Module):
         self.cem_mode = cem_mode
         self.device = device
 
-        self.BML = BernoulliMLSample.apply
+        self.BML = bernoulli_ml_sample
 
         self.edge_del = edge_del  # Can the model delete new edges to the graph
         self.edge_add = edge_add  # Can the model add new edges to the graph
@@ -42,8 +43,38 @@ class GCNSyntheticPerturbOrig(nn.Module):
         elif edge_del and edge_add:
             print("Note: in this implementation enabling edge_add allows for both add and del")
 
+        if self.cem_mode == "PN":
+            raise RuntimeError("GCNSyntheticPerturbOrig: PN is not implemented")
+
+        # Resolve the forward/loss variant once: branching on bernoulli/cem_mode at
+        # every call adds interpreter overhead to the hot loop and blocks fullgraph
+        # tracing in the explainer
+        if self.bernoulli:
+            self.fwd_fn = self.__forward_bernoulli
+
+            if self.cem_mode is None:
+                self.loss_fn = self.__loss_bernoulli
+            elif self.cem_mode == "PP":
+                self.loss_fn = self.__loss_PP_bernoulli
+        else:
+            self.fwd_fn = self.__forward_std
+
+            if self.cem_mode is None:
+                self.loss_fn = self.__loss_std
+            elif self.cem_mode == "PP":
+                self.loss_fn = self.__loss_PP_std
+
         # Number of nodes in the adj, in case of graph-class includes padding
         self.num_nodes_adj = self.adj.shape[1]
+
+        # The identity added by the reparam trick in normalize_adj() never changes:
+        # build it once and pass it down, instead of allocating a fresh eye inside
+        # every forward. Only the node-class model normalizes the adj
+        if task == "node-class":
+            self.fwd_kwargs = {"norm_eye": torch.eye(self.num_nodes_adj,
+                                                     device=self.device)}
+        else:
+            self.fwd_kwargs = {}
         self.init_eps = 10**-6
 
         if 0 < self.rand_init < self.init_eps:
@@ -52,12 +83,19 @@ class GCNSyntheticPerturbOrig(nn.Module):
        # The optimizer will affect only the elements below the diag of this matrix
        # Note: no diagonal, it is assumed to be always 0/no self-connections allowed
         if self.edge_add:
+            # Additions can touch any non-edge, so P keeps the dense parameterization
+            self.symm_from_P = self.__symm_dense
             # Initialize the matrix to the lower triangular part of the adj
             self.P_tril = Parameter(torch.tril(self.adj, -1).detach())
             # Use to avoid sigmoid setting everything to >= 0.5
             self.P_tril[self.P_tril == 0].fill_(-self.init_eps)
         else:
-            self.P_tril = Parameter(torch.ones((self.num_nodes_actual, self.num_nodes_actual),
+            # Deletions only act on existing edges: parameterize P as a 1-D vector
+            # over the tril support of the adj, so the parameter and its optimizer
+            # state scale with the number of edges instead of num_nodes^2
+            self.P_edge_idx = torch.tril(self.adj, -1).nonzero().t()
+            self.symm_from_P = self.__symm_edge_list
+            self.P_tril = Parameter(torch.ones((self.P_edge_idx.shape[1],),
                                                device=self.device))
 
         # The idea behind the init is simply to break any symmetries in the parameters, allowing
@@ -83,20 +121,19 @@ class GCNSyntheticPerturbOrig(nn.Module):
 
 
     def forward(self, x):
+        return self.fwd_fn(x)
 
-        diff_act, pred_act = None, None
 
-        if self.bernoulli:
-            diff_act, pred_act = self.__forward_bernoulli(x)
-        else:
-            diff_act, pred_act = self.__forward_std(x)
+    def __symm_dense(self, values):
+        return create_symm_matrix_tril(values, self.num_nodes_adj)
+
 
-        return diff_act, pred_act
+    def __symm_edge_list(self, values):
+        return create_symm_matrix_from_trilvec(values, self.P_edge_idx, self.num_nodes_adj)
 
 
     def __forward_std(self, x):
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
         # Note: identity matrix is added in normalize_adj() inside the model
@@ -108,15 +145,17 @@ class GCNSyntheticPerturbOrig(nn.Module):
             A_tilde_diff = P_hat_symm * self.adj
             A_tilde_pred = P * self.adj
 
-        output_diff = self.model(x, A_tilde_diff.expand(1, -1, -1)).squeeze()
-        output_pred = self.model(x, A_tilde_pred.expand(1, -1, -1)).squeeze()
+        # Batch the relaxed and thresholded adjacencies into one forward pass: a
+        # single batched matmul chain keeps the device busy instead of two separate
+        # small ones
+        output_batch = self.model(x, torch.stack((A_tilde_diff, A_tilde_pred)), **self.fwd_kwargs)
 
-        return output_diff, output_pred
+        return output_batch[0], output_batch[1]
 
 
     def __forward_bernoulli(self, x):
 
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
 
         # Note: identity matrix is added in normalize_adj() inside model
@@ -125,39 +164,19 @@ class GCNSyntheticPerturbOrig(nn.Module):
         else:       # Learn only P_hat => only edge deletions
             A_tilde = P * self.adj
 
-        output = self.model(x, A_tilde.expand(1, -1, -1)).squeeze()
+        output = self.model(x, A_tilde.expand(1, -1, -1), **self.fwd_kwargs).squeeze()
 
         return output, output
 
 
-    def loss(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
+    def loss(self, output, y_pred_new_actual, prev_expls):
+        return self.loss_fn(output, y_pred_new_actual, prev_expls)
 
-        if self.bernoulli:
-
-            if self.cem_mode is None:
-                res = self.__loss_bernoulli(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PP":
-                res = self.__loss_PP_bernoulli(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PN":
-                raise RuntimeError("GCNSyntheticPerturbOrig: PN is not implemented")
-
-        else:
-
-            if self.cem_mode is None:
-                res = self.__loss_std(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PP":
-                res = self.__loss_PP_std(output, y_pred_orig, y_pred_new_actual, prev_expls)
-            elif self.cem_mode == "PN":
-                raise RuntimeError("GCNSyntheticPerturbOrig: PN is not implemented")
-
-        return res
-
-    def __loss_std(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+    def __loss_std(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
-        pred_same = (y_pred_new_actual == y_pred_orig).float()
+        pred_same = (y_pred_new_actual == self.y_pred_orig_const).float()
 
         if self.edge_add:
             cf_adj_diff = P_hat_symm
@@ -167,15 +186,20 @@ class GCNSyntheticPerturbOrig(nn.Module):
             cf_adj_actual = P * self.adj
 
         # Want negative in front to maximize loss instead of minimizing it to find CFs
-        loss_pred = - F.nll_loss(output, y_pred_orig)
+        loss_pred = - F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges changed (symmetrical), used for the metrics
         loss_graph_dist_actual = torch.sum(torch.abs(cf_adj_actual - self.adj)) / 2
         # Relaxation to continuous space of loss_graph_dist_actual, used for the loss
         loss_graph_dist = torch.sum(torch.abs(cf_adj_diff - self.adj)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj_diff, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj_diff.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         # Note: the distance loss in the original paper is non-differentiable => 
@@ -189,11 +213,11 @@ class GCNSyntheticPerturbOrig(nn.Module):
         return loss_total, loss_graph_dist_actual, cf_adj_diff, cf_adj_actual
 
 
-    def __loss_bernoulli(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+    def __loss_bernoulli(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
 
-        pred_same = (y_pred_new_actual == y_pred_orig).float()
+        pred_same = (y_pred_new_actual == self.y_pred_orig_const).float()
 
         # Note: the differentiable and actual formulations are identical
         if self.edge_add:
@@ -202,13 +226,18 @@ class GCNSyntheticPerturbOrig(nn.Module):
             cf_adj = P * self.adj
 
         # Want negative in front to maximize loss instead of minimizing it to find CFs
-        loss_pred = - F.nll_loss(output, y_pred_orig)
+        loss_pred = - F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges changed (symmetrical)
         loss_graph_dist = torch.sum(torch.abs(cf_adj - self.adj)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_same * loss_pred + self.beta * loss_graph_dist \
@@ -217,20 +246,19 @@ class GCNSyntheticPerturbOrig(nn.Module):
         return loss_total, loss_graph_dist, cf_adj, cf_adj
 
 
-    def __loss_PP_std(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = torch.sigmoid(self.P_tril)
-        P_hat_symm = create_symm_matrix_tril(P_hat_symm, self.num_nodes_adj)
+    def __loss_PP_std(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(torch.sigmoid(self.P_tril))
         P = (P_hat_symm >= 0.5).float()  # Threshold P_hat
 
         # Note: flipped the boolean since we want the same prediction
-        pred_diff = (y_pred_new_actual != y_pred_orig).float()
+        pred_diff = (y_pred_new_actual != self.y_pred_orig_const).float()
 
         # edge_del equivalent
         cf_adj_diff = P_hat_symm * self.adj
         cf_adj_actual = P * self.adj
 
         # Note: the negative sign is gone since we want to keep the same prediction
-        loss_pred = F.nll_loss(output, y_pred_orig)
+        loss_pred = F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges in neighbourhood (symmetrical)
         # Note: here we are interested in finding the most sparse cf_adj with the same pred
         loss_graph_dist = torch.sum(torch.abs(cf_adj_diff)) / 2
@@ -241,8 +269,13 @@ class GCNSyntheticPerturbOrig(nn.Module):
         loss_graph_dist_actual = torch.sum(torch.abs(self.adj - cf_adj_actual)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj_diff, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj_diff.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_diff * loss_pred + self.beta * loss_graph_dist \
@@ -251,18 +284,18 @@ class GCNSyntheticPerturbOrig(nn.Module):
         return loss_total, loss_graph_dist_actual, cf_adj_diff, cf_adj_actual
 
 
-    def __loss_PP_bernoulli(self, output, y_pred_orig, y_pred_new_actual, prev_expls):
-        P_hat_symm = create_symm_matrix_tril(self.P_tril, self.num_nodes_adj)
+    def __loss_PP_bernoulli(self, output, y_pred_new_actual, prev_expls):
+        P_hat_symm = self.symm_from_P(self.P_tril)
         P = self.BML(P_hat_symm)  # Threshold P_hat
 
         # Note: flipped the boolean since we want the same prediction
-        pred_diff = (y_pred_new_actual != y_pred_orig).float()
+        pred_diff = (y_pred_new_actual != self.y_pred_orig_const).float()
 
         # edge_del equivalent
         cf_adj = P * self.adj
 
         # Note: the negative sign is gone since we want to keep the same prediction
-        loss_pred = F.nll_loss(output, y_pred_orig)
+        loss_pred = F.nll_loss(output, self.y_pred_orig_const)
         # Number of edges in neighbourhood (symmetrical)
         # Note: here we are interested in finding the most sparse cf_adj with the same pred
         loss_graph_dist = torch.sum(torch.abs(cf_adj)) / 2
@@ -273,8 +306,13 @@ class GCNSyntheticPerturbOrig(nn.Module):
         loss_graph_dist_actual = torch.sum(torch.abs(self.adj - cf_adj)) / 2
 
         diversity_loss = 0
-        for expl in prev_expls:
-            diversity_loss += F.cross_entropy(cf_adj, expl)
+
+        # One batched cross-entropy over the whole history instead of one small
+        # kernel per entry: the sum of per-entry means equals the mean over the
+        # concatenated batch times the number of entries
+        if len(prev_expls) > 0:
+            diversity_loss = len(prev_expls) * \
+                F.cross_entropy(cf_adj.repeat(len(prev_expls), 1), torch.cat(prev_expls))
 
         # Zero-out loss_pred with pred_same if prediction flips
         loss_total = self.alpha * pred_diff * loss_pred + self.beta * loss_graph_dist \
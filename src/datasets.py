@@ -3,13 +3,14 @@ from __future__ import print_function
 import sys
 import os
 sys.path.append('..')
+import math
 import pickle
 import numpy as np
 from numpy.random import SeedSequence, default_rng
 import pandas as pd
 import torch
-from torch.utils.data import Dataset
-from utils.utils import get_neighbourhood
+from torch.utils.data import Dataset, Sampler
+from utils.utils import get_neighbourhood, mkdir_p
 from torch_geometric.utils import dense_to_sparse, to_dense_adj
 
 
@@ -29,8 +30,10 @@ class SyntheticDataset(Dataset):
         self.test_idx = full_dataset["test_idx"]
         self.complete_idx = self.train_idx + self.test_idx
 
-        self.adj = torch.Tensor(full_dataset["adj"]).squeeze()
-        self.features = torch.Tensor(full_dataset["feat"]).squeeze()
+        # Store the dense tensors contiguous in fp32 so every downstream matmul
+        # hits the fast GEMM path instead of a strided fallback
+        self.adj = torch.Tensor(full_dataset["adj"]).squeeze().contiguous()
+        self.features = torch.Tensor(full_dataset["feat"]).squeeze().contiguous()
         self.labels = torch.LongTensor(full_dataset["labels"]).squeeze()
 
         # Needed for pytorch-geo functions, returns a sparse representation:
@@ -50,10 +53,28 @@ class SyntheticDataset(Dataset):
 
     def __getitem__(self, orig_idx):
 
-        sub_adj, sub_feat, sub_labels, node_dict = \
-            get_neighbourhood(int(orig_idx), self.sparse_adj, self.n_layers + 1, self.features,
-                              self.labels)
-        new_idx = node_dict[int(orig_idx)]
+        # The k-hop extraction depends only on (dataset, node, depth): cache it on
+        # disk so repeated runs, e.g. hyperparameter sweeps, skip the Python-level
+        # graph traversal entirely
+        cache_path = "../cache/{}/node_{}_hops_{}.pt".format(self.dataset_id, int(orig_idx),
+                                                             self.n_layers + 1)
+
+        if os.path.isfile(cache_path):
+            sub_adj, sub_feat, sub_labels, new_idx = \
+                torch.load(cache_path, map_location="cpu")
+        else:
+            sub_adj, sub_feat, sub_labels, node_dict = \
+                get_neighbourhood(int(orig_idx), self.sparse_adj, self.n_layers + 1,
+                                  self.features, self.labels)
+            new_idx = node_dict[int(orig_idx)]
+
+            # Write through a per-process temp file: parallel loader workers may
+            # extract the same node, the rename keeps the cache entry consistent
+            mkdir_p(os.path.dirname(cache_path))
+            tmp_path = "{}.tmp{}".format(cache_path, os.getpid())
+            torch.save((sub_adj, sub_feat, sub_labels, new_idx), tmp_path)
+            os.replace(tmp_path, cache_path)
+
         num_nodes = sub_adj.shape[1]
 
         return sub_adj, sub_feat, sub_labels, orig_idx, new_idx, num_nodes
@@ -91,7 +112,9 @@ class MUTAGDataset(Dataset):
         # adj contains all the single disconnected graphs, need to split them apart
         self.adj = to_dense_adj(torch.LongTensor(sparse_np_adj)).squeeze()
         # Need to remove the top row and the left most col since the nodes in dataset start from 1
-        self.adj = self.adj[1:,:][:, 1:]
+        # The column slice leaves a strided view: store it contiguous so the
+        # dense matmuls downstream hit the fast GEMM path
+        self.adj = self.adj[1:,:][:, 1:].contiguous()
 
         # Group nodes by graph indicator
         graphs_df = pd.DataFrame(np_array_g_ind, columns=["Indicator"])
@@ -112,6 +135,19 @@ class MUTAGDataset(Dataset):
             self.adj_by_graph_arr.append(self.adj[node_array, :][:, node_array])
             self.feat_by_graph_arr.append(self.features[node_array])
 
+        # Pad each graph to the next power of two (capped at the dataset max)
+        # instead of the dataset max: small graphs stop paying dense FLOPs on
+        # rows of zeros, while batches still draw from a handful of fixed
+        # shapes, one per bucket, rather than one per distinct graph size
+        # Note: the ceiling is strictly greater than the node count so every
+        # graph keeps at least one padded row, as under pad-to-max. The max-pool
+        # readout includes the relu(bias) rows the padding produces, so going
+        # from some padding to none would shift the logits of power-of-two
+        # graphs under the shipped checkpoint
+        self.pad_len_by_graph = [min(2 ** math.ceil(math.log2(adj.shape[0] + 1)),
+                                     self.max_num_nodes)
+                                 for adj in self.adj_by_graph_arr]
+
         # The node features are their label
         self.n_features = self.features.shape[1]
         self.n_classes = len(torch.unique(self.labels))
@@ -124,16 +160,15 @@ class MUTAGDataset(Dataset):
 
         cur_adj = self.adj_by_graph_arr[idx]
         num_nodes = cur_adj.shape[0]
-        nodes_diff = abs(self.max_num_nodes - num_nodes)
+        nodes_diff = self.pad_len_by_graph[idx] - num_nodes
 
-        # Pad bottom and right
-        pad_adj_f = torch.nn.ZeroPad2d((0, nodes_diff, 0, nodes_diff))
-        adj_padded = pad_adj_f(cur_adj)
+        # Pad bottom and right with the functional op, instead of building a
+        # fresh nn.Module wrapper around it on every item fetch
+        adj_padded = torch.nn.functional.pad(cur_adj, (0, nodes_diff, 0, nodes_diff))
 
         # Pad bottom
-        pad_feat_f = torch.nn.ZeroPad2d((0, 0, 0, nodes_diff))
         cur_feat = self.feat_by_graph_arr[idx]
-        feat_padded = pad_feat_f(cur_feat)
+        feat_padded = torch.nn.functional.pad(cur_feat, (0, 0, 0, nodes_diff))
 
         # Scalar, no need to pad
         label = self.labels[idx]
@@ -158,6 +193,38 @@ class MUTAGDataset(Dataset):
         return train_idx, test_idx
 
 
+# Batches graphs of the same padded bucket together so the default collate
+# stacks identically shaped tensors and downstream compiled forwards only ever
+# see one shape per bucket instead of one per batch composition
+class BucketedBatchSampler(Sampler):
+
+    def __init__(self, idx_list, pad_len_by_graph, batch_size, seed=42):
+        self.batch_size = batch_size
+        self.rng_gen = default_rng(SeedSequence(seed).spawn(1)[0])
+
+        self.idx_by_bucket = {}
+        for idx in idx_list:
+            self.idx_by_bucket.setdefault(pad_len_by_graph[idx], []).append(idx)
+
+    def __iter__(self):
+        batch_list = []
+
+        # Reshuffle within each bucket and across batches every epoch
+        for bucket_idx_list in self.idx_by_bucket.values():
+            self.rng_gen.shuffle(bucket_idx_list)
+
+            for i in range(0, len(bucket_idx_list), self.batch_size):
+                batch_list.append(bucket_idx_list[i:i + self.batch_size])
+
+        self.rng_gen.shuffle(batch_list)
+
+        return iter(batch_list)
+
+    def __len__(self):
+        return sum(math.ceil(len(bucket) / self.batch_size)
+                   for bucket in self.idx_by_bucket.values())
+
+
 avail_datasets_dict = {"syn1": SyntheticDataset,
                        "syn4": SyntheticDataset,
                        "syn5": SyntheticDataset,
@@ -5,10 +5,11 @@ import sys
 sys.path.append('..')
 import argparse
 import pickle
+import traceback
 import numpy as np
 import time
 import torch
-from torch.multiprocessing import Manager, Pool, Queue, set_start_method, freeze_support
+from torch.multiprocessing import Process, Queue, set_start_method, freeze_support
 from models import GCNSynthetic, GraphAttNet
 from cf_explanation.cf_explainer import CFExplainer
 from utils.utils import get_neighbourhood, safe_open
@@ -16,13 +17,27 @@ from torch_geometric.utils import dense_to_sparse
 import datasets
 
 
+class SubgraphLoaderDataset(torch.utils.data.Dataset):
+    # Thin indirection mapping loader positions to dataset indices, so a
+    # DataLoader can prefetch the test-split subgraphs with parallel workers
+
+    def __init__(self, dataset, idx_list):
+        self.dataset = dataset
+        self.idx_list = idx_list
+
+    def __len__(self):
+        return len(self.idx_list)
+
+    def __getitem__(self, i):
+        return self.dataset[self.idx_list[i]]
+
+
 def setup_env(dataset_id, hid_units=20, dropout_r=0, seed=42, cuda=False):
 
     cuda = cuda and torch.cuda.is_available()
 
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.autograd.set_detect_anomaly(True)
 
     device = None
 
@@ -58,10 +73,20 @@ def setup_env(dataset_id, hid_units=20, dropout_r=0, seed=42, cuda=False):
 
     return dataset, model, device
 
-def error_callback(arg):
-    print("Error: ", arg)
+def client_explain(task_q, res_q, model, device, n_workers=1, worker_id=0):
+
+    # The workers run as parallel processes: cap the intra-op threads so they don't
+    # oversubscribe the cores, and shard them across the available GPUs so multi-GPU
+    # machines scale with the worker count
+    torch.set_num_threads(max(1, torch.get_num_threads() // n_workers))
+
+    if device == "cuda" and torch.cuda.device_count() > 1:
+        torch.cuda.set_device(worker_id % torch.cuda.device_count())
 
-def client_explain(task_q, res_q, device):
+    # The frozen model arrives once through shared memory: move it to the device
+    # here instead of once per task
+    if device == "cuda":
+        model = model.cuda()
 
     while True:
         args = task_q.get()
@@ -73,29 +98,43 @@ def client_explain(task_q, res_q, device):
         expl_par = args[1]
         expl_args = args[2]
 
-        if device == "cuda":
-            expl_par["model"] = expl_par["model"].cuda()
+        expl_par["model"] = model
 
-            expl_par["sub_adj"] = expl_par["sub_adj"].cuda()
-            expl_par["sub_feat"] = expl_par["sub_feat"].cuda()
-            expl_par["sub_label"] = expl_par["sub_label"].cuda()
+        # A raised task must still produce a queue entry: the server drains one
+        # result per task and would otherwise block forever on a failed worker.
+        # Errors cross the queue as [task_idx, traceback, -1] sentinels
+        try:
+            if device == "cuda":
+                # Stage the instance tensors through pinned host memory: the
+                # copies become true async DMA transfers issued back-to-back
+                # instead of serialized pageable copies
+                expl_par["sub_adj"] = expl_par["sub_adj"].pin_memory().cuda(non_blocking=True)
+                expl_par["sub_feat"] = expl_par["sub_feat"].pin_memory().cuda(non_blocking=True)
+                expl_par["sub_label"] = \
+                    expl_par["sub_label"].pin_memory().cuda(non_blocking=True)
 
-            expl_args["y_pred_orig"] = expl_args["y_pred_orig"].cuda()
+                expl_args["y_pred_orig"] = \
+                    expl_args["y_pred_orig"].pin_memory().cuda(non_blocking=True)
 
-        # Need to instantitate new cf_model for each instance because size of P
-        # changes based on size of sub_adj
-        explainer = CFExplainer(**expl_par)
+            # Need to instantitate new cf_model for each instance because size of P
+            # changes based on size of sub_adj
+            explainer = CFExplainer(**expl_par)
 
-        expl, num_tot_expl = explainer.explain(**expl_args)
+            # Note: the explainer already returns its tensors sparsified, so the
+            # payload crosses the queue as O(|E|) edge lists
+            expl, num_tot_expl = explainer.explain(**expl_args)
+
+            result = [task_idx, expl, num_tot_expl]
+        except Exception:
+            result = [task_idx, traceback.format_exc(), -1]
 
-        result = [task_idx, expl, num_tot_expl]
         res_q.put(result)
 
 def server_explain(dataset, model, hid_units=20, n_layers=3, dropout_r=0, seed=42, lr=0.005,
                  optimizer="SGD", n_momentum=0, alpha=1, beta=0.5, gamma=0, num_epochs=500,
                  cem_mode=None, edge_del=False, edge_add=False, delta=False, bernoulli=False,
                  device=None, rand_init=0.5, history=True, hist_len=10, div_hind=1,
-                 n_workers=1, verbosity=0):
+                 patience=0, min_dist=0, n_workers=1, verbosity=0):
 
     # Get explanations for data in test set
     test_expls = []
@@ -104,85 +143,140 @@ def server_explain(dataset, model, hid_units=20, n_layers=3, dropout_r=0, seed=4
     _, test_idx_list = dataset.split_tr_ts_idx()
     num_expl_found = 0
 
-    pool = Pool(processes=n_workers)
-    mgr = Manager()
-    task_queue = mgr.Queue()
-    result_queue = mgr.Queue()
+    # Plain torch.multiprocessing queues: Manager proxies route every put/get
+    # through a broker process and pickle on both hops, which dominates the
+    # dispatch cost for large sub_adj tensors. The workers are spawned directly
+    # so the queues are inherited instead of pickled
+    task_queue = Queue()
+    result_queue = Queue()
+
+    # Share the frozen model storage once: each worker maps it at spawn instead
+    # of deserializing a fresh copy from every task payload
+    model.share_memory()
+
+    workers = []
 
     for i in range(n_workers):
-        pool.apply_async(client_explain, (task_queue, result_queue, device),
-                         error_callback=error_callback)
+        worker = Process(target=client_explain,
+                         args=(task_queue, result_queue, model, device, n_workers, i))
+        worker.start()
+        workers.append(worker)
+
+    inst_list = []
 
-    for i, v in enumerate(test_idx_list):
+    # Prefetch the subgraph extraction with loader workers: the Python-level
+    # k-hop traversal of the next instances overlaps with the processing of the
+    # current one. batch_size=None passes the per-instance tuples through as-is
+    subgraph_loader = torch.utils.data.DataLoader(
+        SubgraphLoaderDataset(dataset, test_idx_list), batch_size=None,
+        num_workers=min(4, len(test_idx_list)), pin_memory=(device == "cuda"))
+
+    for item in subgraph_loader:
 
         if dataset.task == "node-class":
-            sub_adj, sub_feat, sub_labels, orig_idx, new_idx, num_nodes = dataset[v]
-            sub_label = sub_labels[new_idx]
+            sub_adj, sub_feat, sub_labels, orig_idx, new_idx, num_nodes = item
+            inst = {"sub_adj": sub_adj, "sub_feat": sub_feat,
+                    "sub_label": sub_labels[new_idx], "orig_idx": int(orig_idx),
+                    "new_idx": int(new_idx), "num_nodes": int(num_nodes)}
 
         elif dataset.task == "graph-class":
-            sub_adj, sub_feat, sub_label, num_nodes = dataset[v]
+            sub_adj, sub_feat, sub_label, num_nodes = item
+            inst = {"sub_adj": sub_adj, "sub_feat": sub_feat, "sub_label": sub_label,
+                    "num_nodes": int(num_nodes)}
+
+        inst_list.append(inst)
+
+    # Compute the original predictions with one batched forward per subgraph
+    # size: same-size subgraphs stack directly, so a single big matmul chain
+    # replaces the per-instance forwards without any padding involved
+    size_groups = {}
 
-        with torch.no_grad():
-            output = model(sub_feat, sub_adj.expand(1, -1, -1)).squeeze()
+    for idx, inst in enumerate(inst_list):
+        size_groups.setdefault(inst["sub_adj"].shape[-1], []).append(idx)
 
-            if dataset.task == "node-class":
-                y_pred_orig = torch.argmax(output, dim=1)
-                y_pred_orig = y_pred_orig[new_idx]
-            elif dataset.task == "graph-class":
-                y_pred_orig = torch.argmax(output, dim=0)
+    with torch.no_grad():
+        for group in size_groups.values():
+            adj_batch = torch.stack([inst_list[idx]["sub_adj"] for idx in group])
+            feat_batch = torch.stack([inst_list[idx]["sub_feat"] for idx in group])
 
-        expl_par = {"model": model, "cf_optimizer": optimizer, "lr": lr, "n_momentum": n_momentum,
-                    "sub_adj": sub_adj, "num_nodes": num_nodes, "sub_feat": sub_feat,
-                    "n_hid": hid_units, "dropout": dropout_r, "sub_label": sub_label,
+            output_batch = model(feat_batch, adj_batch)
+            pred_batch = torch.argmax(output_batch, dim=-1)
+
+            for pos, idx in enumerate(group):
+                if dataset.task == "node-class":
+                    inst_list[idx]["y_pred_orig"] = \
+                        pred_batch[pos][inst_list[idx]["new_idx"]]
+                elif dataset.task == "graph-class":
+                    inst_list[idx]["y_pred_orig"] = pred_batch[pos]
+
+    task_list = []
+
+    for i, inst in enumerate(inst_list):
+
+        # Note: the model is not part of the payload, it is shared with the
+        # workers at spawn
+        expl_par = {"cf_optimizer": optimizer, "lr": lr, "n_momentum": n_momentum,
+                    "sub_adj": inst["sub_adj"], "num_nodes": inst["num_nodes"],
+                    "sub_feat": inst["sub_feat"], "n_hid": hid_units, "dropout": dropout_r,
+                    "sub_label": inst["sub_label"],
                     "num_classes": dataset.n_classes, "alpha": alpha, "beta": beta, "gamma": gamma,
                     "task": dataset.task, "cem_mode": cem_mode, "edge_del": edge_del,
                     "edge_add": edge_add, "delta": delta, "bernoulli": bernoulli,
                     "rand_init": rand_init, "history": history, "hist_len": hist_len,
-                    "div_hind": div_hind, "device": device, "verbosity": verbosity}
+                    "div_hind": div_hind, "patience": patience, "min_dist": min_dist,
+                    "device": device, "verbosity": verbosity}
 
         if dataset.task == "node-class":
 
-            expl_func_args = {"task": dataset.task, "y_pred_orig": y_pred_orig,
-                              "node_idx": orig_idx, "new_idx": new_idx, "num_epochs": num_epochs}
+            expl_func_args = {"task": dataset.task, "y_pred_orig": inst["y_pred_orig"],
+                              "node_idx": inst["orig_idx"], "new_idx": inst["new_idx"],
+                              "num_epochs": num_epochs}
 
         elif dataset.task == "graph-class":
 
             expl_func_args = {"task": dataset.task, "num_epochs": num_epochs,
-                              "y_pred_orig": y_pred_orig}
+                              "y_pred_orig": inst["y_pred_orig"]}
 
-        task_queue.put([i, expl_par, expl_func_args])
+        task_list.append([i, expl_par, expl_func_args])
+
+    # Bucket the tasks by subgraph size before dispatching: the compiled explainer
+    # graphs are shape-specialized, so feeding each worker a stream of equally-sized
+    # subgraphs reuses the compiled kernels instead of recompiling on every size
+    # change. The result order is unaffected since res_list is sorted by task idx
+    task_list.sort(key=lambda t: t[1]["sub_adj"].shape[-1])
+
+    for task in task_list:
+        task_queue.put(task)
 
     # Put end of work signal in queue
     for i in range(n_workers):
         task_queue.put([])
 
-    # Wait for work completion
-    pool.close()
-    pool.join()
-
     res_list = []
 
-    while not result_queue.empty():
+    # Drain exactly one result per task before joining the workers: with plain
+    # queues a worker blocks on put() until its results are consumed. The
+    # payloads arrive already sparsified, so consuming overlaps with production
+    # and only bookkeeping runs here
+    for _ in range(len(test_idx_list)):
 
         queue_res = result_queue.get()
-        num_expl_inst = queue_res[2]
-        expl_res = queue_res[1]
-
-        if num_expl_inst > 0:
-            num_expl_found += 1
 
-        # Sparsify all relevant tensors
-        for i, expl in enumerate(expl_res[2]):
-            # cf_adj_actual
-            expl_res[2][i][0] = expl_res[2][i][0].to_sparse()
+        # Failed tasks arrive as error sentinels: surface the worker traceback
+        # and keep going with partial results instead of dropping the count
+        if queue_res[2] < 0:
+            print("Explanation of instance {} failed:\n{}".format(queue_res[0], queue_res[1]))
+            continue
 
-        # sub_adj
-        expl_res[3] = expl_res[3].to_sparse()
-        # sub_feat
-        expl_res[4] = expl_res[4].to_sparse()
+        if queue_res[2] > 0:
+            num_expl_found += 1
 
         res_list.append(queue_res)
 
+    # Wait for work completion
+    for worker in workers:
+        worker.join()
+
     # Sort list according to instance idx
     res_list.sort(key=lambda x: x[0])
 
@@ -280,6 +374,12 @@ if __name__ == "__main__":
                         'evenly-spaced elements of the original history.')
     parser.add_argument('--div_hind', type=int, default=5,
                         help='How many previous explanations to include when using diversity loss')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='Stop the explainer after this many epochs without improvement ' + \
+                        'of the graph distance. Assigning 0 disables the early exit')
+    parser.add_argument('--min_dist', type=float, default=0,
+                        help='Stop the explainer once a valid explanation with graph distance ' + \
+                        'at most this value is found. Assigning 0 disables the early exit')
     parser.add_argument('--n_workers', type=int, default=1,
                         help='Number of workers to run to compute the explanation')
     parser.add_argument('--verbosity', type=int, default=0,
@@ -298,4 +398,5 @@ if __name__ == "__main__":
                    args.optimizer, args.n_momentum, args.alpha, args.beta, args.gamma,
                    args.num_epochs, args.cem_mode, args.edge_del, args.edge_add, args.delta,
                    args.bernoulli, device, args.rand_init, not args.no_history,
-                   args.hist_len, args.div_hind, args.n_workers, args.verbosity)
+                   args.hist_len, args.div_hind, args.patience, args.min_dist,
+                   args.n_workers, args.verbosity)
@@ -61,7 +61,7 @@ class GCNSynthetic(nn.Module):
 
         self.dropout = dropout
 
-    def forward(self, x, adj, normalize=True):
+    def forward(self, x, adj, normalize=True, norm_eye=None):
 
         squeezed = False
         # Speed up explainer in case of batch of size 1
@@ -71,7 +71,8 @@ class GCNSynthetic(nn.Module):
             squeezed = True
 
         if normalize:
-            adj = normalize_adj(adj)
+            # norm_eye lets callers in a hot loop reuse one cached identity matrix
+            adj = normalize_adj(adj, norm_eye)
 
         x1 = F.relu(self.gc1(x, adj))
         x1 = F.dropout(x1, self.dropout, training=self.training)
@@ -1,15 +1,16 @@
-import math
+import os
 import time
 import argparse
+import contextlib
 import torch
 import torch.nn as nn
 import numpy as np
 import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
 from torch.utils.data import SubsetRandomSampler, DataLoader
-from utils.utils import get_degree_matrix
-from datasets import SyntheticDataset, MUTAGDataset
+from datasets import SyntheticDataset, MUTAGDataset, BucketedBatchSampler
 from models import GCNSynthetic, GraphAttNet
+from utils.utils import normalize_adj
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 import datasets
 
@@ -20,80 +21,122 @@ import datasets
 def train_graph_classifier(G_dataset, model, device, args):
     train_idx, test_idx = G_dataset.split_tr_ts_idx(train_ratio=args.train_ratio)
 
-    tr_idx_sampler = SubsetRandomSampler(train_idx)
-    tr_dataloader = DataLoader(G_dataset, batch_size=args.batch_size, sampler=tr_idx_sampler)
+    # Worker processes overlap the padding/collation work with the training
+    # step, and pinned batches let the H2D copies below run asynchronously
+    loader_args = {"num_workers": min(4, os.cpu_count() or 1),
+                   "pin_memory": device == "cuda",
+                   "persistent_workers": True}
+
+    # Bucketed batching keeps every batch at one padded shape, so the compiled
+    # forward sees a handful of shapes (one per bucket) instead of recompiling
+    # whenever the batch composition changes
+    tr_batch_sampler = BucketedBatchSampler(train_idx, G_dataset.pad_len_by_graph,
+                                            args.batch_size)
+    tr_dataloader = DataLoader(G_dataset, batch_sampler=tr_batch_sampler, **loader_args)
 
     ts_idx_sampler = SubsetRandomSampler(test_idx)
-    ts_dataloader = DataLoader(G_dataset, sampler=ts_idx_sampler)
+    ts_dataloader = DataLoader(G_dataset, sampler=ts_idx_sampler, **loader_args)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     model.train()
 
+    # The compiled wrapper shares parameters with model, which keeps the plain
+    # state_dict for the final save. Batch sizes vary across graph batches, so
+    # the default mode is used to tolerate the shape changes without recompiling
+    run_model = model
+    if hasattr(torch, "compile") and device == "cuda":
+        run_model = torch.compile(model)
+
+    # bf16 halves the activation bandwidth of the dense matmuls and, unlike
+    # fp16, keeps the fp32 exponent range so no gradient scaler is needed
+    amp_ctx = contextlib.nullcontext()
+    if device == "cuda":
+        amp_ctx = torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+
     for epoch in range(1, args.num_epochs + 1):
-        begin_time = time.time()
+        # Metrics are only printed every 10 epochs: skip collecting them (and
+        # the timing syscalls) on the other epochs instead of computing values
+        # that are thrown away
+        log_epoch = epoch % 10 == 0
+
+        if log_epoch:
+            begin_time = time.time()
 
         avg_loss = 0
-        train_ypred = []
-        train_labels = []
+        # Per-batch logits stay on the device; argmax and the host copy happen
+        # once at epoch end so no batch forces a GPU sync in the hot path
+        epoch_logits = []
+        epoch_labels = []
 
         for batch_idx, data in enumerate(tr_dataloader):
-            model.zero_grad()
+            # set_to_none skips the zero-fill writes; backward allocates fresh grads
+            optimizer.zero_grad(set_to_none=True)
 
             adj, feat, label, _ = data
 
-            ypred = model(feat, adj)
-            loss = model.loss(ypred, label)
+            if device == "cuda":
+                adj = adj.cuda(non_blocking=True)
+                feat = feat.cuda(non_blocking=True)
+                label = label.cuda(non_blocking=True)
+
+            with amp_ctx:
+                ypred = run_model(feat, adj)
+                loss = model.loss(ypred, label)
 
             loss.backward()
             nn.utils.clip_grad_norm_(model.parameters(), args.clip)
             optimizer.step()
 
-            ypred_label = torch.argmax(ypred, axis=1)
-
-            if device == "cuda":
-                ypred_label = ypred_label.cpu()
+            if log_epoch:
+                epoch_logits.append(ypred.detach())
+                epoch_labels.append(label)
+            # Detach before accumulating: keeping the live loss would retain
+            # every batch's autograd graph until the end of the epoch
+            avg_loss += loss.detach()
 
-            train_ypred += ypred_label
-            train_labels += label
-            avg_loss += loss
+        if log_epoch:
+            elapsed = time.time() - begin_time
 
-        elapsed = time.time() - begin_time
+            # Convert to NumPy once, sklearn otherwise iterates the tensors
+            np_train_ypred = torch.cat(epoch_logits).argmax(dim=1).cpu().numpy()
+            np_train_labels = torch.cat(epoch_labels).cpu().numpy()
 
-        if epoch % 10 == 0:
             print(
                 "epoch: ",
                 epoch,
                 "; loss: ",
-                avg_loss/len(train_labels),
+                avg_loss/len(tr_dataloader),
                 "; train_acc: ",
-                accuracy_score(train_ypred, train_labels),
+                accuracy_score(np_train_ypred, np_train_labels),
                 "; train_prec: ",
-                precision_score(train_ypred, train_labels, average=None),
+                precision_score(np_train_ypred, np_train_labels, average=None),
                 "{0:0.2f}".format(elapsed),
             )
 
-    test_ypred = []
+    test_logits = []
     test_labels = []
 
     for idx, data in enumerate(ts_dataloader):
 
         adj, feat, label, _ = data
 
-        ypred = model(feat, adj)
+        if device == "cuda":
+            adj = adj.cuda(non_blocking=True)
+            feat = feat.cuda(non_blocking=True)
 
-        ypred_label = torch.argmax(ypred, axis=1)
+        ypred = run_model(feat, adj)
 
-        if device == "cuda":
-            ypred_label = ypred_label.cpu()
+        test_logits.append(ypred.detach())
+        test_labels.append(label)
 
-        test_ypred += ypred_label
-        test_labels += label
+    np_test_ypred = torch.cat(test_logits).argmax(dim=1).cpu().numpy()
+    np_test_labels = torch.cat(test_labels).cpu().numpy()
 
     print(
         "test_acc: ",
-        accuracy_score(test_ypred, test_labels),
+        accuracy_score(np_test_ypred, np_test_labels),
         "; test_prec: ",
-        precision_score(test_ypred, test_labels, average=None),
+        precision_score(np_test_ypred, np_test_labels, average=None),
     )
 
     torch.save(model.state_dict(), "../models/gcn_3layer_{}.pt".format(args.dataset))
@@ -112,47 +155,82 @@ def train_node_classifier(G_dataset, model, device, args):
     labels_train = G_dataset.labels[train_idx]
     labels_test = G_dataset.labels[test_idx]
 
+    # These tensors never change across the epochs: move them to the device once
+    # instead of paying a fresh H2D copy per epoch. It also keeps conditional
+    # transfers out of the compiled region
+    if args.cuda:
+        adj = adj.cuda()
+        feat = feat.cuda()
+        labels_train = labels_train.cuda()
+
+    # The graph is fixed for the whole training run: normalize it once here and
+    # skip the per-forward normalization inside the model for every epoch
+    adj = normalize_adj(adj)
+
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
     model.train()
+
+    # The compiled wrapper shares parameters with model, which keeps the plain
+    # state_dict for the final save. Full-batch training has fixed shapes every
+    # epoch, so the step can be captured and replayed with CUDA graphs
+    run_model = model
+    if hasattr(torch, "compile") and args.cuda:
+        run_model = torch.compile(model, mode="reduce-overhead")
+
+    # bf16 halves the activation bandwidth of the full-graph matmuls without
+    # needing a gradient scaler; backward runs outside the region as usual
+    amp_ctx = contextlib.nullcontext()
+    if args.cuda:
+        amp_ctx = torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+
     ypred = None
 
     for epoch in range(1, args.num_epochs + 1):
-        begin_time = time.time()
-        model.zero_grad()
+        # Elapsed time is only reported every 10 epochs: keep the timing
+        # syscalls out of the other iterations
+        log_epoch = epoch % 10 == 0
+
+        if log_epoch:
+            begin_time = time.time()
 
-        if args.cuda:
-            ypred = model(feat.cuda(), adj.cuda())
-        else:
-            ypred = model(feat, adj)
+        # set_to_none skips the zero-fill writes; backward allocates fresh grads
+        optimizer.zero_grad(set_to_none=True)
 
-        ypred_train = ypred[train_idx, :]
-        ypred_test = ypred[test_idx, :]
+        with amp_ctx:
+            ypred = run_model(feat, adj, normalize=False)
+
+            ypred_train = ypred[train_idx, :]
+            ypred_test = ypred[test_idx, :]
 
-        if args.cuda:
-            loss = model.loss(ypred_train, labels_train.cuda())
-        else:
             loss = model.loss(ypred_train, labels_train)
 
         loss.backward()
         nn.utils.clip_grad_norm_(model.parameters(), args.clip)
         optimizer.step()
 
-        elapsed = time.time() - begin_time
+        if log_epoch:
+            elapsed = time.time() - begin_time
+
+            # Take each argmax once and hand sklearn NumPy arrays: passing the
+            # tensors repeats the reduction and element conversion per metric
+            np_pred_train = torch.argmax(ypred_train, axis=1).cpu().numpy()
+            np_pred_test = torch.argmax(ypred_test, axis=1).cpu().numpy()
+            np_labels_train = labels_train.cpu().numpy()
+            np_labels_test = labels_test.numpy()
 
-        if epoch % 10 == 0:
             print(
                 "epoch: ",
                 epoch,
                 "; loss: ",
                 loss.item(),
                 "; train_acc: ",
-                accuracy_score(torch.argmax(ypred_train, axis=1), labels_train),
+                accuracy_score(np_pred_train, np_labels_train),
                 "; test_acc: ",
-                accuracy_score(torch.argmax(ypred_test, axis=1), labels_test),
+                accuracy_score(np_pred_test, np_labels_test),
                 "; train_prec: ",
-                precision_score(torch.argmax(ypred_train, axis=1), labels_train, average="macro"),
+                precision_score(np_pred_train, np_labels_train, average="macro"),
                 "; test_prec: ",
-                precision_score(torch.argmax(ypred_test, axis=1), labels_test, average="macro"),
+                precision_score(np_pred_test, np_labels_test, average="macro"),
                 "; epoch time: ",
                 "{0:0.2f}".format(elapsed),
             )
@@ -1,5 +1,6 @@
 import os
 import errno
+import functools
 import torch
 import numpy as np
 import pandas as pd
@@ -7,20 +8,14 @@ from torch_geometric.utils import k_hop_subgraph, dense_to_sparse, to_dense_adj,
 
 
 # Used to implement Bernoulli rv approach to P generation in Srinivas paper
-class BernoulliMLSample(torch.autograd.Function):
+# ML sampling with a pass-through gradient, written as plain ops: the detach
+# trick forwards the hard sample while the gradient flows through the identity,
+# so no custom autograd Function (and no saved input tensor) is needed and the
+# whole thing stays traceable inside compiled regions
+def bernoulli_ml_sample(input):
+    hard_sample = (input >= 0.5).to(input.dtype)
 
-    @staticmethod
-    def forward(ctx, input):
-
-        ctx.save_for_backward(input)
-
-        # ML sampling
-        return (input >= 0.5).float()
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        # Pass-through estimator of bernoulli
-        return grad_output
+    return input + (hard_sample - input).detach()
 
 def mkdir_p(path):
     try:
@@ -43,19 +38,29 @@ def get_degree_matrix(batch_adj):
     return torch.diag_embed(torch.sum(batch_adj, -1))
 
 
+# The identity added by normalize_adj is read-only and depends only on the
+# size/device: cache it so callers that don't pass norm_eye, e.g. per-epoch
+# training forwards, stop allocating a fresh N^2 tensor on every call
+@functools.lru_cache(maxsize=8)
+def get_cached_eye(side_len, device):
+    return torch.eye(side_len, device=device)
+
+
 def normalize_adj(batch_adj, norm_eye=None):
     # Normalize adjacancy matrix according to reparam trick in GCN paper
     if norm_eye is None:
-        A_tilde = batch_adj + torch.eye(batch_adj.shape[1], device=batch_adj.device)
-    else:
-        A_tilde = batch_adj + norm_eye
-    D_tilde = get_degree_matrix(A_tilde).detach()  # Don't need gradient
-    # Raise to power -1/2, set all infs to 0s
-    D_tilde_exp = D_tilde ** (-1 / 2)
-    D_tilde_exp[torch.isinf(D_tilde_exp)] = 0
+        norm_eye = get_cached_eye(batch_adj.shape[1], batch_adj.device)
+    A_tilde = batch_adj + norm_eye
+    # The degree normalization is a diagonal scaling: apply it elementwise on
+    # rows and columns instead of materializing the degree matrix and paying two
+    # dense matmuls, i.e. norm_adj_ij = d_i^(-1/2) * A_tilde_ij * d_j^(-1/2)
+    D_tilde_exp = torch.sum(A_tilde, -1).detach() ** (-1 / 2)  # Don't need gradient
+    # Zero out infs (isolated nodes) in one branchless op: the boolean-index
+    # assignment needed an extra scan plus a data-dependent scatter
+    D_tilde_exp = torch.nan_to_num(D_tilde_exp, posinf=0.0)
 
     # Create norm_adj = (D + I)^(-1/2) * (A + I) * (D + I)^(-1/2)
-    norm_batch_adj = torch.matmul(torch.matmul(D_tilde_exp, A_tilde), D_tilde_exp)
+    norm_batch_adj = A_tilde * D_tilde_exp.unsqueeze(-1) * D_tilde_exp.unsqueeze(-2)
 
     return norm_batch_adj
 
@@ -65,27 +70,44 @@ def get_neighbourhood(node_idx, edge_index, n_hops, features, labels):
     sub_adj = to_dense_adj(edge_subset[1]).squeeze()
     sub_feat = features[edge_subset[0], :]
     sub_labels = labels[edge_subset[0]]
-    new_index = np.array(range(len(edge_subset[0])))
     # Maps orig labels to new
-    node_dict = {edge_subset[0][i].item(): new_index[i] for i in range(len(edge_subset[0]))}
+    # Note: one .tolist() call moves the indices to Python in a single sync,
+    # instead of paying a per-element .item() in a dict comprehension
+    sub_node_idx = edge_subset[0].tolist()
+    node_dict = dict(zip(sub_node_idx, range(len(sub_node_idx))))
     # print("Num nodes in subgraph: {}".format(len(edge_subset[0])))
     return sub_adj, sub_feat, sub_labels, node_dict
 
 
+# Create a symmetric matrix from a 1-D vector of edge values and the tril indices
+# they belong to. Used when P is parameterized over the support of the adj only:
+# the parameter (and its optimizer state) scales with |E| instead of N^2
+# Note: indices are expected below the diagonal, the transpose adds the upper part
+def create_symm_matrix_from_trilvec(vec, tril_index, side_len):
+    symm_matrix = torch.zeros((side_len, side_len), dtype=vec.dtype, device=vec.device)
+    symm_matrix[tril_index[0], tril_index[1]] = vec
+
+    return symm_matrix + symm_matrix.t()
+
+
 # Create a symmetric matrix starting from the lower triangular part of another one
 # The code is designed to avoid allocating additional tensors
 # Note: ignores diagonal, assumes square matrix input
 def create_symm_matrix_tril(matrix, final_side_len):
     orig_side_len = matrix.shape[0]
 
-    symm_matrix = torch.tril(matrix, -1) + torch.tril(matrix, -1).t()
+    # Take the tril once and mirror it: computing it twice scans the matrix
+    # twice and allocates an extra N^2 temporary in the explainer hot loop
+    tril = torch.tril(matrix, -1)
+    symm_matrix = tril + tril.transpose(-1, -2)
 
     # The symmetric matrix needs to be padded
     if final_side_len != orig_side_len:
         nodes_diff = abs(final_side_len - orig_side_len)
 
-        # Pad bottom and right
-        pad_f = torch.nn.ZeroPad2d((0, nodes_diff, 0, nodes_diff))
-        symm_matrix = pad_f(symm_matrix)
+        # Pad bottom and right with the functional op: ZeroPad2d builds an
+        # nn.Module instance per call just to wrap the same function
+        symm_matrix = torch.nn.functional.pad(symm_matrix,
+                                              (0, nodes_diff, 0, nodes_diff))
 
     return symm_matrix